@@ -14,41 +14,70 @@
 
 
 import argparse
+import calendar
 import re
+import warnings
 from datetime import datetime
+from functools import cached_property, lru_cache
 from pathlib import Path
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
 
 import utils
 from config import CLIPPINGS_DIR
 
+_INVALID_FILENAME_CHARS_RE = re.compile(r'[\\/*?:"<>|]')
+_CLIPPING_SEPARATOR = "=========="
+_DATE_FORMAT = "%A, %B %d, %Y %I:%M:%S %p"
+_MONTHS = {name.lower(): ix for ix, name in enumerate(calendar.month_name) if name}
+_METADATA_RE = re.compile(
+    r"^(?P<type>Highlight|Note|- Your Highlight|- Your Note)"  # note/highlight type
+    r"(?:\((?P<color>[^)]+)\))?"  # optional color
+    r".*?Location (?P<location>\d+(?:-\d+)?)"  # full location or range
+    r"(?:.*?Added on (?P<date>.+))?$",  # optional date
+    re.IGNORECASE | re.ASCII,
+)
+
+
+def parse_kindle_date(date):
+    # Hand-rolled parser for `_DATE_FORMAT`, e.g. "Monday, January 1, 2024 1:00:00 AM"
+    try:
+        _, month_day, rest = date.split(", ")
+        month, day = month_day.split(" ")
+        year, time, am_pm = rest.split(" ")
+        hour, minute, second = (int(_) for _ in time.split(":"))
+        am_pm = am_pm.upper()
+        if am_pm not in ("AM", "PM") or not 1 <= hour <= 12:
+            raise ValueError
+        hour = hour % 12 + (12 if am_pm == "PM" else 0)
+        return datetime(int(year), _MONTHS[month.lower()], int(day), hour, minute, second)
+    except (ValueError, KeyError):
+        # Let strptime handle (or reject) anything unexpected
+        return datetime.strptime(date, _DATE_FORMAT)
+
+
+@lru_cache(maxsize=4096)
+def _parse_metadata(metadata):
+    # Kindle often repeats metadata lines (e.g. several highlights added within the same second)
+    match = _METADATA_RE.match(metadata)
+    if not match:
+        raise ValueError(f"Invalid metadata format: {metadata}")
+
+    type = match.group("type").lower()
+    type = "highlight" if "highlight" in type else "note" if "note" in type else None
+    color = match.group("color")
+    location = tuple(int(_) for _ in match.group("location").split("-"))
+    date = match.group("date").strip() if match.group("date") else None
+    date = parse_kindle_date(date) if date else None
+
+    return type, color, location, date
 
-class Clipping:
-    pattern = re.compile(
-        r"^(?P<type>Highlight|Note|- Your Highlight|- Your Note)"  # note/highlight type
-        r"(?:\((?P<color>[^)]+)\))?"  # optional color
-        r".*?Location (?P<location>\d+(?:-\d+)?)"  # full location or range
-        r"(?:.*?Added on (?P<date>.+))?$",  # optional date
-        re.IGNORECASE,
-    )
 
+class Clipping:
     def process_metadata(self, metadata):
-        match = self.pattern.match(metadata)
-        if match:
-            type = match.group("type").lower()
-            type = "highlight" if "highlight" in type else "note" if "note" in type else None
-            color = match.group("color")
-            location = [int(_) for _ in match.group("location").split("-")]
-            date = match.group("date").strip() if match.group("date") else None
-            date = datetime.strptime(date, "%A, %B %d, %Y %I:%M:%S %p") if date else None
-
-            self.type = type
-            self.location = location
-            self.date = date
-            self.color = color
-        else:
-            raise ValueError(f"Invalid metadata format: {metadata}")
+        self.type, self.color, location, self.date = _parse_metadata(metadata)
+        # Cached results are shared, so each clipping gets its own location list
+        self.location = list(location)
 
         if self.type == "note":
             assert len(self.location) == 1, "Notes should have a single location"
@@ -59,6 +88,14 @@ class Clipping:
         self.note = None
         self.content = content
 
+    @cached_property
+    def norm_content(self):
+        return utils.normalize_str(self.content)
+
+    @cached_property
+    def nospace_content(self):
+        return self.norm_content.replace(" ", "")
+
     def __repr__(self):
         if self.type == "highlight":
             return f"Highlight(location={self.location}, date={self.date})"
@@ -68,21 +105,32 @@ class Clipping:
             raise ValueError(f"Unknown clipping type: {self.type}")
 
 
+def iter_clippings(filepath, remove_bom=False):
+    # Stream the clippings file, yielding the non-empty (stripped) lines of each clipping
+    lines = []
+    with open(filepath, "r", encoding="utf-8-sig", buffering=1 << 20) as f:
+        for line in f:
+            if remove_bom:
+                line = line.replace("\ufeff", "")
+
+            # Separators are matched anywhere in the line, as a plain `str.split` on the whole file would
+            for ix, piece in enumerate(line.split(_CLIPPING_SEPARATOR)):
+                if ix > 0:
+                    yield lines
+                    lines = []
+                piece = piece.strip()
+                if piece:
+                    lines.append(piece)
+
+    yield lines
+
+
 def split_txt_clippings_by_title(filepath, clippings_dir):
     if not Path(filepath).is_file():
         raise FileNotFoundError(f"ERROR: cannot find {filepath}")
 
-    with open(filepath, "r", encoding="utf-8-sig") as f:
-        raw = f.read()
-
-    # Remove BOM if present
-    raw = raw.replace("\ufeff", "")
-
-    clippings = raw.split("==========")
     all_clips = []
-
-    for clip in clippings:
-        lines = [line.strip() for line in clip.strip().split("\n") if line.strip()]
+    for lines in iter_clippings(filepath, remove_bom=True):
         if len(lines) < 3:
             continue
 
@@ -92,7 +140,7 @@ def split_txt_clippings_by_title(filepath, clippings_dir):
     # Group clips by title
     clips_by_title = {}
     for clip in all_clips:
-        title = re.sub(r'[\\/*?:"<>|]', "", clip[0])
+        title = _INVALID_FILENAME_CHARS_RE.sub("", clip[0])
         if title not in clips_by_title:
             clips_by_title[title] = []
         clips_by_title[title].append(clip)
@@ -109,14 +157,8 @@ def split_txt_clippings_by_title(filepath, clippings_dir):
 
 def parse_txt_clippings(filepath, log_path=None):
     log = []
-    with open(filepath, "r", encoding="utf-8-sig") as f:
-        raw = f.read()
-
-    clippings = raw.split("==========")
     all_clips = []
-
-    for clip in clippings:
-        lines = [line.strip() for line in clip.strip().split("\n") if line.strip()]
+    for lines in iter_clippings(filepath):
         if len(lines) < 3:
             continue
 
@@ -132,15 +174,18 @@ def parse_txt_clippings(filepath, log_path=None):
     parsed_notes = list(filter(lambda c: c.type == "note", all_clips))
     parsed_notes = sorted(parsed_notes, key=lambda c: c.date)
 
-    for note in parsed_notes:
-        # Find the latest highlight that matches the note's title and location
-        for clip in reversed(parsed_clips):
-            if clip.title == note.title and clip.location[-1] == note.location[0]:
-                clip.note = note.content
-                break
+    # Index the latest highlight for each title and end location
+    last_by_key = {}
+    for clip in parsed_clips:
+        last_by_key[(clip.title, clip.location[-1])] = clip
 
-        warn_str = f"✘ Note '{note.content}' at location {note.location} could not be matched."
-        log.append(warn_str)
+    for note in parsed_notes:
+        clip = last_by_key.get((note.title, note.location[0]))
+        if clip is not None:
+            clip.note = note.content
+        else:
+            warn_str = f"✘ Note '{note.content}' at location {note.location} could not be matched."
+            log.append(warn_str)
 
     if log_path:
         utils.write_to_log(log_path, log)
@@ -152,26 +197,39 @@ def parse_html_clippings(filepath, log_path=None):
     with open(filepath, "r", encoding="utf-8-sig") as f:
         raw = f.read()
 
-    soup = BeautifulSoup(raw, "html.parser")
+    # Kindle exports start with an XML declaration but are meant to be read as HTML
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+        soup = BeautifulSoup(raw, utils.HTML_PARSER)
     title = soup.find("div", class_="bookTitle").get_text().strip()
 
     all_clips = []
     unpaired = []
-    elements = soup.find_all(["div"])
 
-    # TODO: I think HTML elements[0] might sometimes has all the highlights embedded in it
+    # TODO: I think the first HTML div might sometimes has all the highlights embedded in it
 
-    i = 0
-    while i < len(elements) - 1:
-        if elements[i].get("class") == ["noteHeading"] and elements[i + 1].get("class") == ["noteText"]:
-            metadata = elements[i].text.strip()
-            content = elements[i + 1].text.strip()
+    # Walk the divs once (in document order), pairing each heading with an immediately following text div
+    heading = None
+    for element in soup.descendants:
+        if element.name != "div":
+            continue
+
+        element_class = element.get("class")
+        if heading is not None and element_class == ["noteText"]:
+            metadata = heading.text.strip()
+            content = element.text.strip()
             clip = Clipping(title, metadata, content)
             all_clips.append(clip)
-            i += 2  # Skip the matched pair
+            heading = None
+            continue
+
+        if heading is not None:
+            unpaired.append(heading)
+        if element_class == ["noteHeading"]:
+            heading = element
         else:
-            unpaired.append((i, elements[i]))
-            i += 1  # Skip unpaired elements
+            heading = None
+            unpaired.append(element)
 
     for ix in range(1, len(all_clips)):
         assert all_clips[ix - 1].location[0] <= all_clips[ix].location[0], (
@@ -28,3 +28,6 @@ KNOWN_COLORS = {
     "gray": "#dbd6d6c8",
     "dark-gray": "#777777C9",
 }
+
+# Deflate level used when writing the highlighted EPUB: lower is faster, higher gives smaller files
+EPUB_COMPRESSLEVEL = 1
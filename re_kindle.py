@@ -13,8 +13,9 @@
 # limitations under the License.
 
 import argparse
-import difflib
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, groupby
 from pathlib import Path
 
 import ebooklib
@@ -24,7 +25,18 @@ from tqdm import tqdm
 
 import utils
 from clip_utils import parse_clippings
-from config import CLIPPINGS_DIR, KNOWN_COLORS, LOGS_DIR, PROCESSED_DIR
+from config import (
+    CLIPPINGS_DIR,
+    EPUB_COMPRESSLEVEL,
+    KNOWN_COLORS,
+    LOGS_DIR,
+    PROCESSED_DIR,
+)
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 
 class Match:
@@ -39,22 +51,112 @@ class Match:
         return f"Match(clip={self.clip}, spine_ix={self.spine_ix})"
 
 
-def find_clip_in_spine(clip, spine, start_from=0):
-    nospace_clip = "".join(clip.content.split(" "))
-    for item_offset, item in enumerate(spine[start_from:]):
-        soup = BeautifulSoup(item.get_content(), "xml")
-        clean_soup = utils.normalize_str(soup.get_text())
+MATCH_CHUNKSIZE = 16
+
+
+class SpineEntry:
+    def __init__(self, item):
+        self.item = item
+        self.content = item.get_content()
+        self.is_parsed = False
+        self.pars = None
+        self.par_strs = None
+        # Tag-stripped text used to cheaply rule out items before parsing them
+        raw_text = utils.strip_html_tags(self.content)
+        if raw_text is not None:
+            self.nospace_raw = utils.normalize_str(raw_text).replace(" ", "")
+        else:
+            # No reliable cheap text for this item, so gate on the parsed text instead
+            self.parse()
+            self.nospace_raw = self.nospace_soup
+
+    def __getstate__(self):
+        # Worker processes only receive plain strings: items they may need are parsed beforehand in the main
+        # process, so workers never build a soup (and never see the ebooklib item or bs4 objects)
+        state = {"item": None, "content": None, "nospace_raw": self.nospace_raw, "is_parsed": self.is_parsed}
+        if self.is_parsed:
+            if self.par_strs is None:
+                self.par_strs = [str(el) for el in self.pars]
+            state.update(
+                nospace_soup=self.nospace_soup,
+                combined=self.combined,
+                spans=self.spans,
+                pars=None,
+                par_strs=self.par_strs,
+            )
+        return state
+
+    def parse(self):
+        if self.is_parsed:
+            return
+
+        self.soup = BeautifulSoup(self.content, utils.XML_PARSER)
+        self.pars = self.soup.find_all("p")
+        self.normalized_pars = [utils.normalize_str(el.get_text()) for el in self.pars]
+        clean_soup = utils.normalize_str(self.soup.get_text())
+        self.nospace_soup = clean_soup.replace(" ", "")
+        self.combined, self.spans = combine_texts(self.normalized_pars)
+        self.is_parsed = True
+
+    def paragraph_html(self, i):
+        return str(self.pars[i]) if self.pars is not None else self.par_strs[i]
+
+    def __repr__(self):
+        file_name = self.item.file_name if self.item is not None else None
+        return f"SpineEntry(file_name={file_name}, is_parsed={self.is_parsed})"
+
+
+def build_spine_cache(spine):
+    # Spine items are only parsed on the first clipping that passes the cheap text check
+    return [SpineEntry(item) for item in spine]
+
+
+def find_candidate_items(clippings, spine_cache):
+    # Spine indices whose raw text contains each clipping, found with a single Aho-Corasick scan per item
+    if ahocorasick is None:
+        return [
+            [item_ix for item_ix, entry in enumerate(spine_cache) if clip.nospace_content in entry.nospace_raw]
+            for clip in clippings
+        ]
+
+    automaton = ahocorasick.Automaton()
+    for clip_ix, clip in enumerate(clippings):
+        clip_ixs = automaton.get(clip.nospace_content, None)
+        if clip_ixs is None:
+            automaton.add_word(clip.nospace_content, [clip_ix])
+        else:
+            clip_ixs.append(clip_ix)
+    automaton.make_automaton()
+
+    candidate_ixs = [[] for _ in clippings]
+    for item_ix, entry in enumerate(spine_cache):
+        for _, clip_ixs in automaton.iter(entry.nospace_raw):
+            for clip_ix in clip_ixs:
+                if not candidate_ixs[clip_ix] or candidate_ixs[clip_ix][-1] != item_ix:
+                    candidate_ixs[clip_ix].append(item_ix)
+
+    return candidate_ixs
+
+
+def find_clip_in_spine(clip, spine_cache, start_from=0, candidate_ixs=None):
+    nospace_clip = clip.nospace_content
+    if candidate_ixs is None:
+        candidate_ixs = (
+            ix for ix in range(start_from, len(spine_cache)) if nospace_clip in spine_cache[ix].nospace_raw
+        )
 
-        nospace_soup = "".join(clean_soup.split(" "))
-        if nospace_clip in nospace_soup:
-            item_ix = start_from + item_offset
-            pars = soup.find_all("p")
+    for item_ix in candidate_ixs:
+        if item_ix < start_from:
+            continue
 
-            matched_tag_indices = find_text_spans(pars, clip.content)
+        entry = spine_cache[item_ix]
+        entry.parse()
+        if nospace_clip in entry.nospace_soup:
+            matched_tag_indices = find_text_spans_cached(entry.combined, entry.spans, clip.norm_content)
             if matched_tag_indices is None:
                 return None
 
-            all_tag_str = "".join([str(pars[i]) for i in matched_tag_indices])
+            all_tag_str = "".join([entry.paragraph_html(i) for i in matched_tag_indices])
             all_tag_str = utils.normalize_whitespace(all_tag_str)
 
             pre_highlight = utils.min_window_subsequence(all_tag_str, nospace_clip)
@@ -69,19 +171,58 @@ def find_clip_in_spine(clip, spine, start_from=0):
     return None
 
 
-def find_matches(clippings, ebook, log_path):
+# Spine cache of a worker process, set once by `_init_worker` to avoid pickling it for every task
+_worker_spine_cache = None
+
+
+def _init_worker(spine_cache):
+    global _worker_spine_cache
+    _worker_spine_cache = spine_cache
+
+
+def _find_one(clip, candidate_ixs):
+    return find_clip_in_spine(clip, _worker_spine_cache, candidate_ixs=candidate_ixs)
+
+
+def find_matches(clippings, ebook, log_path, num_workers=1):
     spine = list(ebook.get_items_of_type(ebooklib.ITEM_DOCUMENT))
+    spine_cache = build_spine_cache(spine)
     matches = []
     log = []
 
-    for clip_ix in tqdm(range(len(clippings)), desc="Finding matches"):
-        clip = clippings[clip_ix]
-        clip_content = utils.normalize_str(clip.content)
-        match = find_clip_in_spine(clip, spine)
+    use_pool = num_workers > 1 and len(clippings) > MATCH_CHUNKSIZE
+    if clippings and (ahocorasick is not None or use_pool):
+        candidates = find_candidate_items(clippings, spine_cache)
+    else:
+        candidates = [None] * len(clippings)
+
+    if use_pool:
+        # Parse every candidate item once, here, so workers only search the shipped strings
+        for item_ix in set(chain.from_iterable(candidates)):
+            spine_cache[item_ix].parse()
+
+        with ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(spine_cache,)) as executor:
+            found = list(
+                tqdm(
+                    executor.map(_find_one, clippings, candidates, chunksize=MATCH_CHUNKSIZE),
+                    total=len(clippings),
+                    desc="Finding matches",
+                )
+            )
+    else:
+        found = [
+            find_clip_in_spine(clip, spine_cache, candidate_ixs=candidate_ixs)
+            for clip, candidate_ixs in tqdm(zip(clippings, candidates), total=len(clippings), desc="Finding matches")
+        ]
+
+    for clip, match in zip(clippings, found):
+        clip_content = clip.norm_content
 
         if match is None:
             log_str = f"✘ Not found: '{clip_content}'"
         else:
+            # Matches computed in a worker process hold a copy of the clipping
+            match.clip = clip
             log_str = f"✔ Found: '{clip_content}' in {spine[match.spine_ix].file_name}"
             matches.append(match)
 
@@ -95,23 +236,22 @@ def find_matches(clippings, ebook, log_path):
     if len(matches) < len(clippings):
         Warning(f"Only {len(matches)} out of {len(clippings)} highlights found. Check highlight_log.txt for details.")
 
-    return matches
+    return matches, spine_cache
 
 
-def find_text_spans(elements, query):
-    norm_query = utils.normalize_str(query)
-    full_texts = [utils.normalize_str(el.get_text()) for el in elements]
-
-    combined = ""
+def combine_texts(full_texts):
+    # Join the paragraph texts with single spaces, recording the span of each paragraph
     spans = []
+    offset = 0
     for text in full_texts:
-        if combined:
-            combined += " "
-        start = len(combined)
-        combined += text
-        end = len(combined)
-        spans.append((start, end))
+        start = offset
+        offset += len(text) + 1
+        spans.append((start, offset - 1))
+
+    return " ".join(full_texts), spans
+
 
+def find_text_spans_cached(combined, spans, norm_query):
     start_pos = combined.find(norm_query)
     if start_pos == -1:
         return None
@@ -135,11 +275,14 @@ def list_known_clippings(
     do_clippings_title_matching=True,
     pre_fetch_clippings=True,
 ):
+    with os.scandir(clippings_library_dir) as entries:
+        clippings_files = [entry.name for entry in entries if entry.name.endswith((".txt", ".html"))]
+
     if do_clippings_title_matching:
         # Fuzzy match clippings to ebook_name
-        matched_clippings = difflib.get_close_matches(book_name, os.listdir(clippings_library_dir), n=3, cutoff=0.5)
+        matched_clippings = utils.get_close_matches(book_name, clippings_files, n=3, cutoff=0.5)
     else:
-        matched_clippings = [file for file in os.listdir(clippings_library_dir) if file.endswith((".txt", ".html"))]
+        matched_clippings = clippings_files
 
     if len(matched_clippings) == 0:
         print(f"No matching clippings files found for book '{book_name}'.")
@@ -157,10 +300,9 @@ def list_known_clippings(
                 pre_fetched_clippings.append(None)
 
         # Sort in descending number of highlights/notes for easy selection of most relevant
-        pre_fetched_clippings = sorted(pre_fetched_clippings, key=lambda x: len(x) if x else 0, reverse=True)
-        matched_clippings = sorted(
-            matched_clippings, key=lambda x: len(pre_fetched_clippings[matched_clippings.index(x)])
-        )
+        paired = list(zip(matched_clippings, pre_fetched_clippings))
+        paired.sort(key=lambda p: len(p[1]) if p[1] else 0, reverse=True)
+        matched_clippings, pre_fetched_clippings = map(list, zip(*paired))
 
     if do_clippings_title_matching:
         print(f"\n💽 Available clippings in '{clippings_library_dir}' matching EPUB name:")
@@ -187,12 +329,24 @@ def list_known_clippings(
 def list_known_epubs(ebook_library_dir):
     # List all EPUB files found (recursively) in the given path
     epub_files = []
-    for root, dirs, files in os.walk(ebook_library_dir):
-        # Skip hidden folders
-        dirs[:] = [d for d in dirs if not d.startswith(".")]
-        for file in files:
-            if file.endswith(".epub") and not file.startswith("."):
-                epub_files.append((file, os.path.join(root, file)))
+    pending_dirs = [ebook_library_dir]
+    while pending_dirs:
+        try:
+            entries = os.scandir(pending_dirs.pop())
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                # Skip hidden folders and files
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    # Like os.walk, do not descend into symlinked folders
+                    if not entry.is_symlink():
+                        pending_dirs.append(entry.path)
+                elif entry.name.endswith(".epub"):
+                    epub_files.append((entry.name, entry.path))
 
     if len(epub_files) == 0:
         print(f"No EPUB files found in {ebook_library_dir}.")
@@ -216,6 +370,7 @@ def process_book(
     do_clippings_title_matching=True,
     pre_fetch_clippings=True,
     highlight_color=None,
+    num_workers=1,
 ):
     if os.path.exists(ebook_path):
         filename = os.path.basename(ebook_path)
@@ -238,25 +393,31 @@ def process_book(
         clippings = parse_clippings(clips_path, log_path=log_path)
 
     ebook = epub.read_epub(ebook_path)
-    spine = list(ebook.get_items_of_type(ebooklib.ITEM_DOCUMENT))
 
-    matches = find_matches(clippings, ebook, log_path=log_path)
+    matches, spine_cache = find_matches(clippings, ebook, log_path=log_path, num_workers=num_workers)
 
-    for match in tqdm(matches, desc="Applying highlights"):
-        raw_item = spine[match.spine_ix]
-        soup = BeautifulSoup(raw_item.get_content(), "xml")
-        pars = soup.find_all("p")
-        new_tags = utils.create_highlighted_tags(match, highlight_color=highlight_color)
+    # Apply all highlights of a spine item to its cached soup, then serialize it once.
+    # The sort is stable, so overlapping highlights are still applied in clippings order.
+    matches_by_item = sorted(matches, key=lambda m: m.spine_ix)
+    with tqdm(total=len(matches), desc="Applying highlights") as pbar:
+        for spine_ix, item_matches in groupby(matches_by_item, key=lambda m: m.spine_ix):
+            entry = spine_cache[spine_ix]
+            entry.parse()
 
-        for ix, orig_ix in enumerate(match.matched_tag_indices):
-            pars[orig_ix].replace_with(new_tags[ix])
+            for match in item_matches:
+                new_tags = utils.create_highlighted_tags(match, highlight_color=highlight_color)
+                for ix, orig_ix in enumerate(match.matched_tag_indices):
+                    entry.pars[orig_ix].replace_with(new_tags[ix])
+                    # Keep the paragraph list in sync with the tree for later matches in this item
+                    entry.pars[orig_ix] = new_tags[ix]
+                pbar.update()
 
-        raw_item.set_content(str(soup).encode("utf-8"))
+            entry.item.set_content(str(entry.soup).encode("utf-8"))
 
     # Write the modified EPUB back to disk
     processed_path = PROCESSED_DIR / f"{book_name}.epub"
     processed_path.parent.mkdir(parents=True, exist_ok=True)
-    epub.write_epub(processed_path, ebook)
+    epub.write_epub(processed_path, ebook, {"compresslevel": EPUB_COMPRESSLEVEL})
 
     print(f"\n✅ Done - {len(matches)}/{len(clippings)} highlights applied.")
     print(f"📄 Log saved to '{log_path}'")
@@ -288,6 +449,9 @@ def argparse_setup():
     )
 
     parser.add_argument("--highlight_color", type=str, help="Color to use for highlights (default: gray).")
+    parser.add_argument(
+        "--num_workers", type=int, default=1, help="Number of processes used to find highlights (default: 1)."
+    )
 
     return parser
 
@@ -332,4 +496,5 @@ if __name__ == "__main__":
         do_clippings_title_matching=args.smart_title_matching,
         pre_fetch_clippings=args.pre_fetch_clippings,
         highlight_color=highlight_color,
+        num_workers=args.num_workers,
     )
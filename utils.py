@@ -1,6 +1,56 @@
+import difflib
+import html
 import re
-
-from bs4 import BeautifulSoup
+from collections import defaultdict
+
+from bs4 import BeautifulSoup, UnicodeDammit
+
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:
+    process = None
+
+# BeautifulSoup features backed by lxml
+HTML_PARSER = "lxml"
+XML_PARSER = "lxml-xml"
+
+# Unicode whitespace characters (excluding ASCII whitespace: space, tab, newline, etc.)
+_UNICODE_WHITESPACE = "".join(
+    [
+        "\u00a0",  # non-breaking space
+        "\u1680",  # ogham space mark
+        "\u180e",  # mongolian vowel separator
+        "\u2000",
+        "\u2001",
+        "\u2002",
+        "\u2003",
+        "\u2004",
+        "\u2005",
+        "\u2006",
+        "\u2007",
+        "\u2008",
+        "\u2009",
+        "\u200a",  # various thin spaces
+        "\u202f",  # narrow no-break space
+        "\u205f",  # medium mathematical space
+        "\u3000",  # ideographic space
+        "\ufeff",  # byte order mark (zero-width non-breaking)
+    ]
+)
+
+_HEX_COLOR_RE = re.compile(r"^#(?:[0-9a-fA-F]{3,4}|[0-9a-fA-F]{6}(?:[0-9a-fA-F]{2})?)$")
+_WS_RE = re.compile(r"\s+")
+_UNI_WS_RE = re.compile(f"[{re.escape(_UNICODE_WHITESPACE)}]")
+# Markup that never contributes text (comments, tags, processing instructions) or, for CDATA sections, contributes
+# its content verbatim. Quoted attribute values may contain ">".
+_MARKUP_RE = re.compile(
+    r"<!--.*?-->"  # comment
+    r"|<!\[CDATA\[(?P<cdata>.*?)\]\]>"  # CDATA section
+    r"""|<(?:"[^"]*"|'[^']*'|[^'">])*>""",  # tag, declaration or processing instruction
+    re.DOTALL,
+)
+# Regex to match either </p> or <p ...>
+_SPLIT_P_RE = re.compile(r"(</p>|<p[^>]*>)")
 
 
 def is_valid_hex_color(color):
@@ -13,8 +63,16 @@ def is_valid_hex_color(color):
     if not isinstance(color, str):
         return False
 
-    pattern = re.compile(r"^#(?:[0-9a-fA-F]{3,4}|[0-9a-fA-F]{6}(?:[0-9a-fA-F]{2})?)$")
-    return bool(pattern.fullmatch(color))
+    return bool(_HEX_COLOR_RE.fullmatch(color))
+
+
+def get_close_matches(word, possibilities, n=3, cutoff=0.5):
+    # Same contract as difflib.get_close_matches, using rapidfuzz when it is available
+    if process is None:
+        return difflib.get_close_matches(word, possibilities, n=n, cutoff=cutoff)
+
+    matches = process.extract(word, possibilities, scorer=fuzz.ratio, limit=n, score_cutoff=cutoff * 100)
+    return [match for match, _, _ in matches]
 
 
 def write_to_log(log_path, log):
@@ -40,91 +98,73 @@ def interactive_choice(num_options, has_default=True, default_choice=0, prompt="
 
 def normalize_str(s):
     # # Remove all kinds of whitespace and collapse to single space
-    return re.sub(r"\s+", " ", s).strip()
+    return _WS_RE.sub(" ", s).strip()
 
 
 def normalize_whitespace(s):
-    # Unicode whitespace characters (excluding ASCII whitespace: space, tab, newline, etc.)
-    unicode_whitespace = "".join(
-        [
-            "\u00a0",  # non-breaking space
-            "\u1680",  # ogham space mark
-            "\u180e",  # mongolian vowel separator
-            "\u2000",
-            "\u2001",
-            "\u2002",
-            "\u2003",
-            "\u2004",
-            "\u2005",
-            "\u2006",
-            "\u2007",
-            "\u2008",
-            "\u2009",
-            "\u200a",  # various thin spaces
-            "\u202f",  # narrow no-break space
-            "\u205f",  # medium mathematical space
-            "\u3000",  # ideographic space
-            "\ufeff",  # byte order mark (zero-width non-breaking)
-        ]
-    )
-
     # Replace each Unicode whitespace character with a regular space
-    pattern = f"[{re.escape(unicode_whitespace)}]"
-    return re.sub(pattern, " ", s)
+    return _UNI_WS_RE.sub(" ", s)
+
+
+def strip_html_tags(raw):
+    # Cheap text extraction from raw (X)HTML bytes, without building a parse tree. The result contains all the text
+    # a parser would see, or is None when that cannot be guaranteed (undecodable input or custom DTD entities).
+    markup = UnicodeDammit(raw, is_html=False).unicode_markup if isinstance(raw, bytes) else raw
+    if markup is None or "<!ENTITY" in markup:
+        return None
+
+    if "<![CDATA[" not in markup:
+        return html.unescape(_MARKUP_RE.sub("", markup))
+
+    # CDATA content is kept verbatim, so only the text between markup is unescaped
+    pieces = []
+    pos = 0
+    for match in _MARKUP_RE.finditer(markup):
+        pieces.append(html.unescape(markup[pos : match.start()]))
+        if match.group("cdata"):
+            pieces.append(match.group("cdata"))
+        pos = match.end()
+    pieces.append(html.unescape(markup[pos:]))
+
+    return "".join(pieces)
 
 
 def min_window_subsequence(s, t):
-    m, n = len(s), len(t)
+    if not t:
+        return ""
+
     min_len = float("inf")
     start_idx = -1
 
-    i = 0
-    while i < m:
-        # Step 1: Move `j` to match t
-        if s[i] == t[0]:
-            j = 0
-            k = i
-            while k < m:
-                if s[k] == t[j]:
-                    j += 1
-                    if j == n:
-                        break
-                k += 1
-            if j == n:
-                # Step 2: Backtrack to minimize window
-                end = k
-                j -= 1
-                while k >= i:
-                    if s[k] == t[j]:
-                        j -= 1
-                        if j < 0:
-                            break
-                    k -= 1
-                if end - k < min_len:
-                    min_len = end - k
-                    start_idx = k + 1
-                i = k  # Continue from next position
-        i += 1
+    i = s.find(t[0])
+    while i != -1:
+        # Step 1: Move forward to match t
+        k = i
+        for ch in t:
+            k = s.find(ch, k)
+            if k == -1:
+                break
+            k += 1
+        if k == -1:
+            # No later start can match t either
+            break
+
+        # Step 2: Backtrack to minimize window
+        end = k - 1
+        for ch in reversed(t):
+            k = s.rfind(ch, i, k)
+        if end - k < min_len:
+            min_len = end - k
+            start_idx = k + 1
+        i = s.find(t[0], k + 1)  # Continue from next position
 
     return s[start_idx - 1 : start_idx + min_len] if start_idx != -1 else ""
 
 
 def split_raw_html_on_pars(html):
-    # Regex to match either </p> or <p ...>
-    pattern = r"(</p>|<p[^>]*>)"
-
-    # Split and keep the delimiters
-    parts = re.split(pattern, html)
-
-    # Merge into desired structure: [chunk, </p>, <p...>, chunk, ...]
-    result = []
-    i = 0
-    while i < len(parts):
-        if parts[i].strip() != "":
-            result.append(parts[i])
-        i += 1
-
-    return result
+    # Split, keep the delimiters and drop blank chunks in the same pass:
+    # [chunk, </p>, <p...>, chunk, ...]
+    return [part for part in _SPLIT_P_RE.split(html) if part.strip()]
 
 
 def create_highlighted_tags(match, highlight_color):
@@ -154,9 +194,17 @@ def create_highlighted_tags(match, highlight_color):
     tail_count = sum(1 for _ in to_insert if _[1] == HIGHLIGHT_TAIL)
     assert head_count == tail_count, f"Mismatch in highlight tags: {head_count} heads and {tail_count} tails."
 
-    # Insert the highlight tags in to_insert
-    for offset, (i, tag) in enumerate(to_insert):
-        html_tags.insert(offset + i, tag)
+    # Insert the highlight tags in to_insert with a single pass over html_tags
+    tags_at = defaultdict(list)
+    for i, tag in to_insert:
+        tags_at[i].append(tag)
+
+    highlighted_tags = []
+    for i, part in enumerate(html_tags):
+        highlighted_tags.extend(tags_at[i])
+        highlighted_tags.append(part)
+    highlighted_tags.extend(tags_at[len(html_tags)])
+    html_tags = highlighted_tags
 
     if match.clip.note:
         note_tag = f'<span class="note" style="color: gray; font-style: italic; font-size: 90%;"> [R.N.: {match.clip.note}] </span>'